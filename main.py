@@ -1,45 +1,100 @@
 # main.py
+import asyncio
+import json
 import time
 
 import uvicorn
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
 
 from app.graph import app as agent_app
-from app.graph import conversations_col
+from app.graph import conversations_col, stream_answer
 
 #  Setup App
 app = FastAPI(
     title="Agri-Chatbot API",
     description="Agentic RAG for Citrus Diseases & Schemes",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # orjson encodes responses in C
 )
 
 #  Pydantic Models (Input/Output format)
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     query: str
     session_id: str = "default_user"
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     answer: str
     intent: str
     processing_time: float
 
-# 3. API Endpoint
-@app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
-    start_time = time.time()
-    
-    # Get History (if MongoDB available)
-    history = ""
-    if conversations_col is not None:
+@app.on_event("startup")
+async def verify_mongo():
+    # motor connects lazily, so ping once a loop exists and fall back to
+    # stateless mode if the cluster is unreachable
+    global conversations_col
+    if conversations_col is None:
+        return
+    try:
+        await conversations_col.database.client.admin.command('ping')
+        print(" MongoDB Connected")
+    except Exception as e:
+        print(f" MongoDB unavailable: {e}")
+        print("   Running in stateless mode (no conversation memory)")
+        conversations_col = None
+
+# Mongo helpers (shared by both chat endpoints, no-ops in stateless mode)
+async def get_history(session_id: str) -> str:
+    if conversations_col is None:
+        return ""
+    try:
+        # $slice projection: Mongo returns only the last 4 messages rather
+        # than shipping the whole history array over the wire
+        hist_doc = await conversations_col.find_one(
+            {"session_id": session_id}, {"messages": {"$slice": -4}})
+        if hist_doc:
+            return "\n".join([f"{m['role']}: {m['content']}" for m in hist_doc.get('messages', [])])
+    except Exception:
+        pass
+    return ""
+
+# Strong refs for fire-and-forget tasks: asyncio only weakly references
+# scheduled tasks, so an unreferenced write could be GC'd mid-execution
+_pending_writes = set()
+
+def save_interaction(session_id: str, query: str, answer: str):
+    """Fire-and-forget: persistence runs after the response, off the hot path."""
+    if conversations_col is None:
+        return
+
+    async def _write():
         try:
-            hist_doc = conversations_col.find_one({"session_id": request.session_id})
-            if hist_doc:
-                history = "\n".join([f"{m['role']}: {m['content']}" for m in hist_doc['messages'][-4:]])
+            await conversations_col.update_one(
+                {"session_id": session_id},
+                {"$push": {"messages": {"$each": [
+                    {"role": "user", "content": query, "timestamp": time.time()},
+                    {"role": "assistant", "content": answer, "timestamp": time.time()}
+                ]}}},
+                upsert=True
+            )
         except Exception:
             pass
-    
+
+    task = asyncio.create_task(_write())
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+
+# 3. API Endpoints
+@app.post("/chat", response_model=ChatResponse)
+async def chat_endpoint(request: ChatRequest):
+    start_time = time.perf_counter()
+    history = await get_history(request.session_id)
+
     # Run Agent
     try:
         inputs = {
@@ -47,36 +102,52 @@ async def chat_endpoint(request: ChatRequest):
             "chat_history": history,
             "intent": "", "documents": [], "answer": ""
         }
-        result = agent_app.invoke(inputs)
-        
-        # Save Interaction (if MongoDB available)
-        if conversations_col is not None:
-            try:
-                conversations_col.update_one(
-                    {"session_id": request.session_id},
-                    {"$push": {"messages": {"$each": [
-                        {"role": "user", "content": request.query, "timestamp": time.time()},
-                        {"role": "assistant", "content": result['answer'], "timestamp": time.time()}
-                    ]}}},
-                    upsert=True
-                )
-            except Exception:
-                pass
-        
+        result = await agent_app.ainvoke(inputs)
+        save_interaction(request.session_id, request.query, result['answer'])
+
         return ChatResponse(
             answer=result['answer'],
             intent=result.get('intent', 'unknown'),
-            processing_time=time.time() - start_time
+            processing_time=time.perf_counter() - start_time
         )
-        
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """SSE variant of /chat: tokens flush as Groq produces them, cutting
+    time-to-first-byte from the full generation time to the first token."""
+    history = await get_history(request.session_id)
+    inputs = {
+        "question": request.query,
+        "chat_history": history,
+        "intent": "", "documents": [], "answer": ""
+    }
+
+    async def event_stream():
+        parts = []
+        try:
+            async for token in stream_answer(inputs):
+                parts.append(token)
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            # Mirror /chat's error path: report the failure over the stream
+            # instead of silently dropping the connection mid-answer
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        else:
+            save_interaction(request.session_id, request.query, "".join(parts))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/health")
 def health_check():
     mongo_status = "connected" if conversations_col is not None else "unavailable (stateless)"
     return {"status": "active", "mongodb": mongo_status}
 
 #  Run Server (If run directly)
+# In production run `uvicorn main:app --workers N` with N * OMP_NUM_THREADS
+# (pinned in app/graph.py) roughly equal to the physical core count
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file